@@ -9,14 +9,31 @@ Run `BraTS Similarity Metrics Computation` command from CaPTk and return:
   - Precision
 """
 import os
+import re
+import csv
 import subprocess
 import argparse
 import json
+import tempfile
+import warnings
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
+import numpy as np
 import pandas as pd
 import synapseclient
 import utils
 
+METRICS = ("Dice", "Hausdorff95", "Sensitivity", "Specificity", "Precision")
+LABELS = ("ET", "TC", "WT")
+COLUMNS = [f"{metric}_{label}" for metric in METRICS for label in LABELS]
+
+# Scores given to a scan that could not be scored.
+PENALTIES = {"Dice": 0.0, "Hausdorff95": 374.0, "Sensitivity": 0.0,
+             "Specificity": 0.0, "Precision": 0.0}
+
+SCAN_RE = re.compile(r"(\d{5})\.nii\.gz$")
+GOLD_RE = re.compile(r"(\d{5})_seg\.nii\.gz$")
+
 
 def get_args():
     """Set up command-line interface and get arguments."""
@@ -33,6 +50,10 @@ def get_args():
                         type=str, default="results.json")
     parser.add_argument("-c", "--captk_path",
                         type=str, default="/work/CaPTk")
+    parser.add_argument("-n", "--num_workers",
+                        type=int, default=os.cpu_count())
+    parser.add_argument("-t", "--tmp_dir",
+                        type=str, default="tmpdir")
     return parser.parse_args()
 
 
@@ -47,7 +68,8 @@ def run_captk(path_to_captk, pred, gold, tmp):
         "-lsb", pred,
         "-o", tmp
     ]
-    subprocess.check_call(cmd)
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                   text=True, errors="replace", check=True)
 
 
 def extract_metrics(tmp, scan_id):
@@ -60,57 +82,127 @@ def extract_metrics(tmp, scan_id):
       - sensitivity
       - precision
     """
-    res = (
-        pd.read_csv(tmp, index_col="Labels")
-        .filter(items=["Labels", "Dice", "Hausdorff95",
-                       "Sensitivity", "Specificity",
-                       "Precision"])
-        .filter(items=["ET", "WT", "TC"], axis=0)
-        .reset_index()
-        .assign(scan_id=f"BraTS2021_{scan_id}")
-        .pivot(index="scan_id", columns="Labels")
-    )
-    res.columns = ["_".join(col).strip() for col in res.columns]
+    with open(tmp, newline="") as f:
+        rows = {row["Labels"]: row for row in csv.DictReader(f)
+                if row["Labels"] in LABELS}
+    res = {"scan_id": f"BraTS2021_{scan_id}"}
+    for metric in METRICS:
+        for label in LABELS:
+            if label in rows:
+                value = rows[label].get(metric)
+                res[f"{metric}_{label}"] = float(value or "nan")
     return res
 
 
-def score(parent, pred_lst, captk_path, tmp_output="tmp.csv"):
-    """Compute and return scores for each scan."""
+def penalized_scores(scan_id):
+    """Get penalized scores for a scan that could not be scored."""
+    scan_scores = {"scan_id": f"BraTS2021_{scan_id}*"}
+    for metric in METRICS:
+        for label in LABELS:
+            scan_scores[f"{metric}_{label}"] = PENALTIES[metric]
+    return scan_scores
+
+
+def score_scan(scan_id, pred, gold, captk_path, csv_dir="."):
+    """Compute and return scores for a single scan.
+
+    The prediction file is removed once scored.
+    """
+    tmp_output = os.path.join(csv_dir, f"tmp_{scan_id}.csv")
+    try:
+        run_captk(captk_path, pred, gold, tmp_output)
+        scan_scores = extract_metrics(tmp_output, scan_id)
+        os.remove(tmp_output)  # Remove file, as it's no longer needed
+    except subprocess.CalledProcessError as err:
+        # If no output found, give penalized scores.
+        print(f"CaPTk failed on case {scan_id}:\n{err.stderr}")
+        scan_scores = penalized_scores(scan_id)
+    finally:
+        os.remove(pred)
+    return scan_scores
+
+
+def score(golds, preds, captk_path, num_workers=None, tmp_dir="tmpdir"):
+    """Compute and return scores for each scan.
+
+    `golds` maps each case ID to its goldstandard filepath.
+    `preds` is an iterable of (filename, file object) pairs, as given by
+    `utils.iter_files`. Each prediction is extracted into `tmp_dir` only
+    once a worker is available to score it, so that at most a few
+    predictions are on disk at any time. Each scan is scored by its own
+    CaPTk process; up to `num_workers` processes are run in parallel.
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    # CaPTk's per-scan CSV output is only read back once, so keep it in
+    # memory-backed storage where available.
+    shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tmp_dir
     scores = []
-    for pred in pred_lst:
-        scan_id = pred[-12:-7]
-        gold = os.path.join(parent, f"BraTS2021_{scan_id}_seg.nii.gz")
-        try:
-            run_captk(captk_path, pred, gold, tmp_output)
-            scan_scores = extract_metrics(tmp_output, scan_id)
-            os.remove(tmp_output)  # Remove file, as it's no longer needed
-        except subprocess.CalledProcessError:
-            # If no output found, give penalized scores.
-            scan_scores = (
-                pd.DataFrame({
-                    "scan_id": [f"BraTS2021_{scan_id}*"],
-                    "Dice_ET": [0], "Dice_TC": [0], "Dice_WT": [0],
-                    "Hausdorff95_ET": [374], "Hausdorff95_TC": [374],
-                    "Hausdorff95_WT": [374], "Sensitivity_ET": [0],
-                    "Sensitivity_TC": [0], "Sensitivity_WT": [0],
-                    "Specificity_ET": [0], "Specificity_TC": [0],
-                    "Specificity_WT": [0], "Precision_ET": [0],
-                    "Precision_TC": [0], "Precision_WT": [0]
-                })
-                .set_index("scan_id")
-            )
-        scores.append(scan_scores)
-    return pd.concat(scores).sort_values(by="scan_id")
+    with tempfile.TemporaryDirectory(dir=shm_dir) as csv_dir, \
+            ProcessPoolExecutor(max_workers=num_workers) as executor:
+        pending = set()
+        for name, img in preds:
+            # Skip files without a case ID; these are flagged by validation.
+            match = SCAN_RE.search(name)
+            if not match:
+                continue
+            scan_id = match.group(1)
+
+            # Penalize predictions with no goldstandard to score against.
+            gold = golds.get(scan_id)
+            if gold is None:
+                print(f"No goldstandard found for case {scan_id}")
+                scores.append(penalized_scores(scan_id))
+                continue
+
+            if len(pending) >= num_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                scores.extend(future.result() for future in done)
+            pred = utils.extract_file(name, img, path=tmp_dir)
+            pending.add(executor.submit(
+                score_scan, scan_id, pred, gold, captk_path, csv_dir))
+        scores.extend(future.result() for future in wait(pending).done)
+    return (
+        pd.DataFrame(scores, columns=["scan_id", *COLUMNS])
+        .set_index("scan_id")
+        .sort_values(by="scan_id")
+    )
+
+
+def summarize(results):
+    """Get summary statistics of the scores across all scans.
+
+    Missing scores are ignored, as with pandas' own reductions.
+    """
+    scores = results.to_numpy()
+    with warnings.catch_warnings():
+        # A metric with no scores at all is summarized as NaN.
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        stats = {
+            "mean": np.nanmean(scores, axis=0),
+            "sd": np.nanstd(scores, axis=0, ddof=1),
+            "median": np.nanmedian(scores, axis=0),
+            "25quantile": np.nanquantile(scores, 0.25, axis=0),
+            "75quantile": np.nanquantile(scores, 0.75, axis=0),
+        }
+    return pd.DataFrame.from_dict(stats, orient="index",
+                                  columns=results.columns)
 
 
 def main():
     """Main function."""
     args = get_args()
-    preds = utils.unzip_file(args.predictions_file)
-    golds = utils.unzip_file(args.goldstandard_file)
+    golds = {}
+    for gold in utils.unzip_file(args.goldstandard_file):
+        match = GOLD_RE.search(gold)
+        if match:
+            golds[match.group(1)] = gold
+    preds = utils.iter_files(args.predictions_file)
 
-    dir_name = os.path.split(golds[0])[0]
-    results = score(dir_name, preds, args.captk_path)
+    results = score(golds, preds, args.captk_path,
+                    num_workers=args.num_workers, tmp_dir=args.tmp_dir)
 
     # Get number of segmentations predicted by participant, number of
     # segmentation that could not be scored, and number of segmentations
@@ -119,24 +211,21 @@ def main():
     flagged_cases = int(results.reset_index().scan_id.str.count(r"\*").sum())
     cases_evaluated = cases_predicted - flagged_cases
 
-    results.loc["mean"] = results.mean()
-    results.loc["sd"] = results.std()
-    results.loc["median"] = results.median()
-    results.loc["25quantile"] = results.quantile(q=0.25)
-    results.loc["75quantile"] = results.quantile(q=0.75)
+    summary = summarize(results)
 
-    # CSV file of scores for all scans.
+    # CSV file of scores for all scans, followed by their summary.
     results.to_csv("all_scores.csv")
+    summary.to_csv("all_scores.csv", mode="a", header=False)
     syn = synapseclient.Synapse(configPath=args.synapse_config)
     syn.login(silent=True)
-    csv = synapseclient.File("all_scores.csv", parent=args.parent_id)
-    csv = syn.store(csv)
+    scores_file = synapseclient.File("all_scores.csv", parent=args.parent_id)
+    scores_file = syn.store(scores_file)
 
     # Results file for annotations.
     with open(args.output, "w") as out:
-        res_dict = {**results.loc["mean"].to_dict(),
+        res_dict = {**summary.loc["mean"].to_dict(),
                     "cases_evaluated": cases_evaluated,
-                    "submission_scores": csv.id,
+                    "submission_scores": scores_file.id,
                     "submission_status": "SCORED"}
         res_dict = {k: v for k, v in res_dict.items() if not pd.isna(v)}
         out.write(json.dumps(res_dict))
@@ -1,8 +1,20 @@
 """Common util functions for validation and scoring."""
+import contextlib
 import os
+import shutil
 import tarfile
 import zipfile
 
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+# Buffer size for reading archives and copying out their members; the
+# defaults (10 KiB for tarball streams, 8 KiB for file reads) make for
+# many small reads of multi-MB NIfTI members.
+BUFSIZE = 2 * 1024 * 1024
+
 
 def _is_hidden(member):
     """Check whether file is hidden or not."""
@@ -28,14 +40,57 @@ def _filter_zip(members):
     return files_to_extract
 
 
+def _is_gzip(f):
+    """Check whether file is gzip-compressed."""
+    with open(f, "rb") as fh:
+        return fh.read(2) == b"\x1f\x8b"
+
+
+@contextlib.contextmanager
+def _open_tar(f, stream=False):
+    """Open tarball for reading, optionally in streaming mode.
+
+    If rapidgzip is installed, gzipped tarballs are decompressed in
+    parallel across all cores rather than by Python's gzip module.
+
+    tarfile only buffers reads in streaming mode (`bufsize`); otherwise,
+    the tarball is read through a buffered file object instead.
+    rapidgzip already reads its input in large chunks.
+    """
+    if rapidgzip is not None and _is_gzip(f):
+        with rapidgzip.open(f, parallelization=os.cpu_count()) as gz:
+            if stream:
+                tar_ref = tarfile.open(fileobj=gz, mode="r|",
+                                       bufsize=BUFSIZE)
+            else:
+                tar_ref = tarfile.open(fileobj=gz, mode="r:")
+            with tar_ref:
+                yield tar_ref
+    elif stream:
+        with tarfile.open(f, "r|*", bufsize=BUFSIZE) as tar_ref:
+            yield tar_ref
+    else:
+        with open(f, "rb", buffering=BUFSIZE) as fh:
+            with tarfile.open(fileobj=fh, mode="r:*") as tar_ref:
+                yield tar_ref
+
+
+@contextlib.contextmanager
+def _open_zip(f):
+    """Open zip file for reading, with a large read buffer."""
+    with open(f, "rb", buffering=BUFSIZE) as fh:
+        with zipfile.ZipFile(fh) as zip_ref:
+            yield zip_ref
+
+
 def unzip_file(f, path="."):
     """Untar or unzip file."""
     if zipfile.is_zipfile(f):
-        with zipfile.ZipFile(f) as zip_ref:
+        with _open_zip(f) as zip_ref:
             imgs = _filter_zip(zip_ref.infolist())
             zip_ref.extractall(path=path, members=imgs)
     elif tarfile.is_tarfile(f):
-        with tarfile.open(f) as tar_ref:
+        with _open_tar(f) as tar_ref:
             members = _filter_tar(tar_ref)
             def is_within_directory(directory, target):
                 
@@ -62,3 +117,39 @@ def unzip_file(f, path="."):
         imgs = []
 
     return imgs
+
+
+def iter_files(f):
+    """Iterate over the files in a tarball or zipped archive.
+
+    Members are read in archive order without extracting the archive;
+    yields the filename and a file object of its contents, which is only
+    valid until the next file is yielded.
+    """
+    if zipfile.is_zipfile(f):
+        with _open_zip(f) as zip_ref:
+            for name in _filter_zip(zip_ref.infolist()):
+                with zip_ref.open(name) as member:
+                    yield name, member
+    elif tarfile.is_tarfile(f):
+        with _open_tar(f, stream=True) as tar_ref:
+            for member in tar_ref:
+                if member.isfile() and not _is_hidden(member.name):
+                    yield member.name, tar_ref.extractfile(member)
+
+
+def list_files(f):
+    """List the files in a tarball or zipped archive without extracting."""
+    return [name for name, _ in iter_files(f)]
+
+
+def extract_file(name, fileobj, path="."):
+    """Write a single archive member to `path` and return its filepath.
+
+    The member's parent directories are dropped, so that it cannot be
+    written outside of `path`.
+    """
+    filepath = os.path.join(path, os.path.basename(name))
+    with open(filepath, "wb") as out:
+        shutil.copyfileobj(fileobj, out, BUFSIZE)
+    return filepath
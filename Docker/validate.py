@@ -4,13 +4,19 @@
 Predictions file must be a tarball or zipped archive of NIfTI files
 (*.nii.gz). Each NIfTI file must have an ID in its filename.
 """
-import os
+import gzip
 import argparse
 import json
 
 import nibabel as nib
+from nibabel.spatialimages import HeaderDataError
+from nibabel.wrapstruct import WrapStructError
+import pandas as pd
 import utils
 
+# NIfTI header classes by header size (sizeof_hdr).
+NIFTI_HEADERS = {348: nib.Nifti1Header, 540: nib.Nifti2Header}
+
 
 def get_args():
     """Set up command-line interface and get arguments."""
@@ -21,32 +27,65 @@ def get_args():
                         type=str, default="/goldstandard.zip")
     parser.add_argument("-e", "--entity_type",
                         type=str, required=True)
-    parser.add_argument("-t", "--tmp_dir",
-                        type=str, default="tmpdir")
     parser.add_argument("-o", "--output", type=str)
     return parser.parse_args()
 
 
-def check_file_contents(img, parent):
-    """Check that the file can be opened as NIfTI."""
+def check_file_contents(img):
+    """Check that the file contents can be opened as NIfTI (-1 or -2)."""
     try:
-        nib.load(os.path.join(parent, img))
+        # Only the header is read, rather than the full image. Its first
+        # four bytes give the header size, which tells NIfTI-1 and NIfTI-2
+        # apart; it may be stored in either byte order.
+        with gzip.GzipFile(fileobj=img) as nifti:
+            sizeof_hdr = nifti.read(4)
+            for byteorder in ("little", "big"):
+                header_class = NIFTI_HEADERS.get(
+                    int.from_bytes(sizeof_hdr, byteorder))
+                if header_class is not None:
+                    break
+            else:
+                return "invalid"
+            header_size = header_class.template_dtype.itemsize
+            header_class(sizeof_hdr + nifti.read(header_size - 4))
         return "valid"
-    except nib.filebasedimages.ImageFileError:
+    except (HeaderDataError, WrapStructError, OSError, EOFError):
         return "invalid"
 
 
-def validate_file_format(preds, parent):
+def read_predictions(f):
+    """Get the filenames in the predictions file, along with whether
+    each NIfTI file can be opened, without extracting the archive.
+
+    Files are no longer opened once one is found to be invalid.
+    """
+    preds, contents = [], {}
+    checking = True
+    for pred, img in utils.iter_files(f):
+        preds.append(pred)
+
+        # The submission is invalid as soon as one file is, so there is
+        # no need to read any more headers after that.
+        if checking:
+            if pred.endswith(".nii.gz"):
+                contents[pred] = check_file_contents(img)
+                checking = contents[pred] == "valid"
+            else:
+                checking = False
+    return preds, contents
+
+
+def validate_file_format(preds, contents):
     """Check that all files are NIfTI files (*.nii.gz)."""
     error = []
-    if all(pred.endswith(".nii.gz") for pred in preds):
+    for pred in preds:
+        if not pred.endswith(".nii.gz"):
+            return ["Not all files in the archive are NIfTI files (*.nii.gz)."]
 
         # Ensure that all file contents are NIfTI.
-        if not all(check_file_contents(pred, parent) == "valid" for pred in preds):
+        if contents.get(pred) == "invalid":
             error = [("One or more predictions cannot be opened as a "
                       "NIfTI file.")]
-    else:
-        error = ["Not all files in the archive are NIfTI files (*.nii.gz)."]
     return error
 
 
@@ -54,17 +93,23 @@ def validate_filenames(preds, golds):
     """Check that every NIfTI filename ends with a case ID."""
     error = []
 
-    case_ids = [pred[-12:-7] for pred in preds]
-    if all(case_id.isdigit() for case_id in case_ids):
+    case_ids = (
+        pd.Series(preds, dtype=str)
+        .str.extract(r"(\d{5})\.nii\.gz$", expand=False)
+    )
+    if case_ids.notna().all():
 
         # Check that all case IDs are unique.
-        if len(set(case_ids)) != len(case_ids):
+        if case_ids.duplicated().any():
             error.append("Duplicate predictions found for one or more cases.")
 
         # Check that case IDs are known (e.g. has corresponding gold file).
-        gold_case_ids = {gold[-16:-11] for gold in golds}
-        unknown_ids = set(case_ids) - gold_case_ids
-        if unknown_ids:
+        gold_case_ids = (
+            pd.Series(golds, dtype=str)
+            .str.extract(r"(\d{5})_seg\.nii\.gz$", expand=False)
+        )
+        unknown_ids = case_ids[~case_ids.isin(gold_case_ids)].unique()
+        if unknown_ids.size:
             error.append(
                 f"Unknown case IDs found: {', '.join(sorted(unknown_ids))}")
     else:
@@ -85,10 +130,10 @@ def main():
             f"Submission must be a File, not {entity_type}."
         )
     else:
-        preds = utils.unzip_file(args.predictions_file, path=args.tmp_dir)
-        golds = utils.unzip_file(args.goldstandard_file)
+        preds, contents = read_predictions(args.predictions_file)
+        golds = utils.list_files(args.goldstandard_file)
         if preds:
-            invalid_reasons.extend(validate_file_format(preds, args.tmp_dir))
+            invalid_reasons.extend(validate_file_format(preds, contents))
             invalid_reasons.extend(validate_filenames(preds, golds))
         else:
             invalid_reasons.append(
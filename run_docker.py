@@ -3,14 +3,32 @@ from __future__ import print_function
 import argparse
 import getpass
 import os
+import queue
 import tarfile
-import time
+import threading
 import glob
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 import docker
 import synapseclient
 
+# Buffer size used when copying file contents into/out of a tarball; the
+# tarfile default (16 KiB) makes for many small reads and writes with
+# multi-GB prediction files.
+COPY_BUFSIZE = 2 * 1024 * 1024
+
+# Cases are run concurrently but share one log file, so only one thread
+# may write it at a time.
+LOG_LOCK = threading.Lock()
+
+# Size and Synapse entity of each log file when it was last stored; log
+# files are only ever appended to, so an unchanged size means there is
+# nothing new to upload. Uploads take their own lock, so that a slow
+# upload does not hold up writing to the log file.
+STORED_LOGS = {}
+STORE_LOCK = threading.Lock()
+
 
 def create_log_file(log_filename, log_text=None, mode="w"):
     """Create log file"""
@@ -24,17 +42,62 @@ def create_log_file(log_filename, log_text=None, mode="w"):
             log_file.write("No Logs")
 
 
+def _write_log_lines(log_file, case_id, data):
+    """Write complete log lines to log file, each prefixed by its case"""
+    log_text = data.decode("utf-8", "ignore")
+    log_text = "".join(f"[case{case_id}] {line}\n"
+                       for line in log_text.split("\n"))
+    print(log_text, end="")
+    with LOG_LOCK:
+        log_file.write(log_text.encode("ascii", "ignore").decode("ascii"))
+        log_file.flush()
+
+
+def stream_log_file(container, log_filename, case_id):
+    """Append container logs to log file as they are produced
+
+    Logs are only written a complete line at a time, so that lines from
+    cases being run at the same time are not mixed together.
+    """
+    # Unfinished last line of the logs so far.
+    partial = b""
+    with open(log_filename, "a") as log_file:
+        try:
+            for chunk in container.logs(stream=True, follow=True,
+                                        stdout=True, stderr=True):
+                lines, sep, partial = (partial + chunk).rpartition(b"\n")
+                if sep:
+                    _write_log_lines(log_file, case_id, lines)
+        except Exception as err:
+            # Record the failure in the log rather than losing it in a
+            # background thread; the container itself keeps running.
+            if partial:
+                _write_log_lines(log_file, case_id, partial)
+                partial = b""
+            _write_log_lines(log_file, case_id,
+                             f"Unable to capture logs: {err}".encode())
+        if partial:
+            _write_log_lines(log_file, case_id, partial)
+
+
 def store_log_file(syn, log_filename, parentid, store=True):
-    """Store log file"""
-    statinfo = os.stat(log_filename)
-    print(f"storing logs: {statinfo.st_size}")
-    if statinfo.st_size > 0 and statinfo.st_size/1000.0 <= 50:
-        ent = synapseclient.File(log_filename, parent=parentid)
-        if store:
-            try:
-                syn.store(ent)
-            except synapseclient.core.exceptions.SynapseHTTPError as err:
-                print(err)
+    """Store log file, if it has changed since it was last stored"""
+    with STORE_LOCK:
+        statinfo = os.stat(log_filename)
+        last_size, ent = STORED_LOGS.get(log_filename, (None, None))
+        if statinfo.st_size == last_size:
+            return
+        print(f"storing logs: {statinfo.st_size}")
+        if statinfo.st_size > 0 and statinfo.st_size/1000.0 <= 50:
+            if ent is None:
+                ent = synapseclient.File(log_filename, parent=parentid)
+            if store:
+                try:
+                    ent = syn.store(ent, forceVersion=False)
+                except synapseclient.core.exceptions.SynapseHTTPError as err:
+                    print(err)
+                    return
+            STORED_LOGS[log_filename] = (statinfo.st_size, ent)
 
 
 def remove_docker_container(container_name):
@@ -66,15 +129,21 @@ def remove_docker_image(image_name):
         print("Unable to remove image")
 
 
-def tar(directory, tar_filename):
-    """Tar all files in a directory
+def tar(filenames, tar_filename, arcdir):
+    """Tar files into a directory within the tarball, without first
+    moving them there
 
     Args:
-        directory: Directory path to files to tar
+        filenames: Paths to files to tar
         tar_filename:  tar file path
+        arcdir: Directory name the files are stored under in the tarball
     """
-    with tarfile.open(tar_filename, "w") as tar_o:
-        tar_o.add(directory)
+    with tarfile.open(tar_filename, "w",
+                      copybufsize=COPY_BUFSIZE) as tar_o:
+        for filename in filenames:
+            tar_o.add(filename,
+                      arcname=os.path.join(arcdir,
+                                           os.path.basename(filename)))
 
 
 def untar(directory, tar_filename):
@@ -84,7 +153,8 @@ def untar(directory, tar_filename):
         directory: Path to directory to untar files
         tar_filename:  tar file path
     """
-    with tarfile.open(tar_filename, "r") as tar_o:
+    with tarfile.open(tar_filename, "r",
+                      copybufsize=COPY_BUFSIZE) as tar_o:
         def is_within_directory(directory, target):
             
             abs_directory = os.path.abspath(directory)
@@ -107,6 +177,71 @@ def untar(directory, tar_filename):
         safe_extract(tar_o, path=directory)
 
 
+def run_case(syn, args, client, docker_image, case_folder, output_dir,
+             log_filename, gpu_id):
+    """Run docker model on one case folder, using a single GPU"""
+    # Case folders are named after their case, e.g. BraTS2021_00001.
+    case_id = os.path.basename(os.path.normpath(case_folder)).split("_")[-1]
+
+    print("mounting volumes")
+    # Specify the input directory with 'ro' permissions, output with
+    # 'rw' permissions.
+    mounted_volumes = {output_dir: '/output:rw',
+                       case_folder: '/input:ro'}
+
+    # Format the mounted volumes so that Docker SDK can understand.
+    all_volumes = [output_dir, case_folder]
+    volumes = {}
+    for vol in all_volumes:
+        volumes[vol] = {'bind': mounted_volumes[vol].split(":")[0],
+                        'mode': mounted_volumes[vol].split(":")[1]}
+
+    # Run the Docker container in detached mode and with access
+    # to its GPU.
+    container_name = f"{args.submissionid}_case{case_id}"
+    print(f"running container: {container_name} (GPU {gpu_id})")
+    device_requests = [
+        docker.types.DeviceRequest(device_ids=[str(gpu_id)],
+                                   capabilities=[['gpu']])
+    ]
+    try:
+        container = client.containers.run(docker_image,
+                                          detach=True,
+                                          volumes=volumes,
+                                          name=container_name,
+                                          network_disabled=True,
+                                          stderr=True,
+                                          device_requests=device_requests)
+    except docker.errors.APIError as err:
+        container = None
+        remove_docker_container(container_name)
+        errors = str(err) + "\n"
+    else:
+        errors = ""
+
+    # Stream logs into the log file in the background, storing it every
+    # 60 seconds. Remove the container once it has exited; the log stream
+    # ending does not guarantee that it has.
+    if container is not None:
+        log_thread = threading.Thread(target=stream_log_file,
+                                      args=(container, log_filename, case_id),
+                                      daemon=True)
+        log_thread.start()
+        while log_thread.is_alive():
+            log_thread.join(timeout=60)
+            store_log_file(syn, log_filename,
+                           args.parentid, store=args.store)
+        container.wait()
+        container.remove()
+
+    if errors:
+        with LOG_LOCK:
+            create_log_file(log_filename, log_text=f"[case{case_id}] {errors}",
+                            mode="a")
+        store_log_file(syn, log_filename,
+                       args.parentid, store=args.store)
+
+
 def main(syn, args):
     """Run docker model"""
     if args.status == "INVALID":
@@ -152,74 +287,32 @@ def main(syn, args):
         "/home/ec2-user/RSNA_ASNR_MICCAI_BraTS2021_ValidationData_5Cases/BraTS2021_00027",
         "/home/ec2-user/RSNA_ASNR_MICCAI_BraTS2021_ValidationData_5Cases/BraTS2021_00037"
     ]
-    for case_folder in case_folders:
-        # case_folder = os.path.join(input_dir, sub_dir)
-        case_id = case_folder[-5:]
-
-        print("mounting volumes")
-        # Specify the input directory with 'ro' permissions, output with
-        # 'rw' permissions.
-        mounted_volumes = {output_dir: '/output:rw',
-                           case_folder: '/input:ro'}
-
-        # Format the mounted volumes so that Docker SDK can understand.
-        all_volumes = [output_dir, case_folder]
-        volumes = {}
-        for vol in all_volumes:
-            volumes[vol] = {'bind': mounted_volumes[vol].split(":")[0],
-                            'mode': mounted_volumes[vol].split(":")[1]}
-
-        # Run the Docker container in detached mode and with access
-        # to the GPU.
-        container_name = f"{args.submissionid}_case{case_id}"
-        print(f"running container: {container_name}")
+
+    # Run one case per GPU at a time; each worker takes a free GPU from
+    # the queue for the duration of its case.
+    gpus = queue.Queue()
+    for gpu_id in range(args.gpus):
+        gpus.put(gpu_id)
+
+    def run_case_on_gpu(case_folder):
+        gpu_id = gpus.get()
         try:
-            container = client.containers.run(docker_image,
-                                              detach=True,
-                                              volumes=volumes,
-                                              name=container_name,
-                                              network_disabled=True,
-                                              stderr=True,
-                                              runtime="nvidia")
-        except docker.errors.APIError as err:
-            container = None
-            remove_docker_container(container_name)
-            errors = str(err) + "\n"
-        else:
-            errors = ""
-
-        # Capture logs every 60 seconds. Remove the container when done.
-        if container is not None:
-            while container in client.containers.list():
-                log_text = container.logs()
-                create_log_file(log_filename, log_text=log_text)
-                store_log_file(syn, log_filename,
-                               args.parentid, store=args.store)
-                time.sleep(60)
-
-            # Must run again to make sure all the logs are captured
-            log_text = container.logs()
-            create_log_file(log_filename, log_text=log_text)
-            store_log_file(syn, log_filename,
-                           args.parentid, store=args.store)
-            container.remove()
+            run_case(syn, args, client, docker_image, case_folder,
+                     output_dir, log_filename, gpu_id)
+        finally:
+            gpus.put(gpu_id)
 
-        statinfo = os.stat(log_filename)
-        if statinfo.st_size == 0 and errors:
-            create_log_file(log_filename, log_text=errors)
-            store_log_file(syn, log_filename,
-                           args.parentid, store=args.store)
+    with ThreadPoolExecutor(max_workers=args.gpus) as executor:
+        list(executor.map(run_case_on_gpu, case_folders))
 
     print("finished inference")
     remove_docker_image(docker_image)
 
     # Check for prediction files once the Docker run is complete. Tar
     # the predictions if found; else, mark the submission as INVALID.
-    if glob.glob("*.nii.gz"):
-        os.mkdir("predictions")
-        for nifti in glob.glob("*.nii.gz"):
-            os.rename(nifti, os.path.join("predictions", nifti))
-        tar("predictions", "predictions.tar.gz")
+    predictions = glob.glob("*.nii.gz")
+    if predictions:
+        tar(predictions, "predictions.tar.gz", "predictions")
         status = "VALIDATED"
         invalid_reasons = ""
     else:
@@ -254,7 +347,11 @@ if __name__ == '__main__':
     parser.add_argument("--parentid", required=True,
                         help="Parent Id of submitter directory")
     parser.add_argument("--status", required=True, help="Docker image status")
+    parser.add_argument("--gpus", type=int, default=1,
+                        help="Number of GPUs, i.e. cases to run at once")
     args = parser.parse_args()
+    if args.gpus < 1:
+        parser.error("--gpus must be at least 1")
     syn = synapseclient.Synapse(configPath=args.synapse_config)
     syn.login(silent=True)
     main(syn, args)